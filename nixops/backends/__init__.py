@@ -2,57 +2,91 @@
 
 import os
 import re
+import shlex
 import subprocess
-from typing import Dict, Any, List, Optional, Union, Set
+import tempfile
+from typing import (
+    Dict,
+    Any,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Union,
+    Set,
+    Tuple,
+)
 import nixops.util
+import nixops.parallel
 import nixops.resources
 import nixops.ssh_util
 import xml.etree.ElementTree as ET
 
+# Patterns for the lines of "systemctl --all --full --no-legend". _UNIT_RE
+# matches units whose ACTIVE column is "failed" or "activating". Newer
+# systemd versions prefix failed or not-found units with a bullet, which
+# both patterns skip.
+_UNIT_RE = re.compile(
+    r"^(?:● )?(?P<unit>[^ ]+) +[^ ]+ +(?P<state>failed|activating) "
+)
+_MOUNT_RE = re.compile(r"^(?:● )?([^.]+\.mount) .* inactive .*$")
+
+
+class _KeyUpload(NamedTuple):
+    name: str
+    source: str
+    target: str
+
+
+def _parse_load_avg(loadavg: str) -> List[str]:
+    res = loadavg.rstrip().split(" ")
+    assert len(res) >= 3
+    return res
+
+
+def _attr_value(attrs: Mapping[Optional[str], ET.Element], name: str) -> Optional[str]:
+    """Return the value of the typed element inside the attribute ‘name’."""
+    attr = attrs.get(name)
+    return None if attr is None else attr[0].get("value")
+
 
 class MachineDefinition(nixops.resources.ResourceDefinition):
     """Base class for NixOps machine definitions."""
 
     def __init__(self, xml, config={}) -> None:
         nixops.resources.ResourceDefinition.__init__(self, xml, config)
-        self.store_keys_on_machine = (
-            xml.find("attrs/attr[@name='storeKeysOnMachine']/bool").get("value")
-            == "true"
-        )
-        self.ssh_port = int(xml.find("attrs/attr[@name='targetPort']/int").get("value"))
-        self.always_activate = (
-            xml.find("attrs/attr[@name='alwaysActivate']/bool").get("value") == "true"
-        )
-        self.owners = [
-            e.get("value")
-            for e in xml.findall("attrs/attr[@name='owners']/list/string")
-        ]
-        self.has_fast_connection = (
-            xml.find("attrs/attr[@name='hasFastConnection']/bool").get("value")
-            == "true"
-        )
+
+        # Index the attributes once instead of running an XPath query
+        # (each of which scans all children) per option.
+        attrs = {a.get("name"): a for a in xml.find("attrs")}
+
+        self.store_keys_on_machine = _attr_value(attrs, "storeKeysOnMachine") == "true"
+        target_port = _attr_value(attrs, "targetPort")
+        if target_port is None:
+            raise Exception(
+                "machine ‘{0}’ has no ‘targetPort’ defined".format(self.name)
+            )
+        self.ssh_port = int(target_port)
+        self.always_activate = _attr_value(attrs, "alwaysActivate") == "true"
+        owners = attrs.get("owners")
+        self.owners = [] if owners is None else [e.get("value") for e in owners[0]]
+        self.has_fast_connection = _attr_value(attrs, "hasFastConnection") == "true"
 
         def _extract_key_options(x: ET.Element) -> Dict[str, str]:
+            key_attrs = {a.get("name"): a for a in x[0]}
             opts = {}
-            for (key, xmlType) in (
-                ("text", "string"),
-                ("keyFile", "path"),
-                ("destDir", "string"),
-                ("user", "string"),
-                ("group", "string"),
-                ("permissions", "string"),
-            ):
-                elem = x.find("attrs/attr[@name='{0}']/{1}".format(key, xmlType))
-                if elem is not None:
-                    value = elem.get("value")
-                    if value is not None:
-                        opts[key] = value
+            for key in ("text", "keyFile", "destDir", "user", "group", "permissions"):
+                value = _attr_value(key_attrs, key)
+                if value is not None:
+                    opts[key] = value
             return opts
 
-        self.keys = {
-            k.get("name"): _extract_key_options(k)
-            for k in xml.findall("attrs/attr[@name='keys']/attrs/attr")
-        }
+        keys = attrs.get("keys")
+        self.keys = (
+            {}
+            if keys is None
+            else {k.get("name"): _extract_key_options(k) for k in keys[0]}
+        )
 
 
 class MachineState(nixops.resources.ResourceState):
@@ -95,8 +129,21 @@ class MachineState(nixops.resources.ResourceState):
         self.ssh.register_host_fun(self.get_ssh_name)
         self.ssh.register_passwd_fun(self.get_ssh_password)
         self._ssh_private_key_file: Optional[str] = None
+        self._ssh_flags: Optional[Tuple[Tuple[str, ...], Tuple[str, ...]]] = None
         self.new_toplevel: Optional[str] = None
 
+    def _set_attrs(self, attrs: Dict[str, Any]) -> None:
+        # Drop the SSH flags cached by get_ssh_flags() when the port changes,
+        # however the attribute is written.
+        if "targetPort" in attrs:
+            self._ssh_flags = None
+        nixops.resources.ResourceState._set_attrs(self, attrs)
+
+    def _del_attr(self, name: str) -> None:
+        if name == "targetPort":
+            self._ssh_flags = None
+        nixops.resources.ResourceState._del_attr(self, name)
+
     def prefix_definition(self, attr):
         return attr
 
@@ -124,13 +171,9 @@ class MachineState(nixops.resources.ResourceState):
     def get_load_avg(self) -> Union[List[str], None]:
         """Get the load averages on the machine."""
         try:
-            res = (
+            return _parse_load_avg(
                 self.run_command("cat /proc/loadavg", capture_stdout=True, timeout=15)
-                .rstrip()
-                .split(" ")
             )
-            assert len(res) >= 3
-            return res
         except nixops.ssh_util.SSHConnectionFailed:
             return None
         except nixops.ssh_util.SSHCommandFailed:
@@ -145,8 +188,30 @@ class MachineState(nixops.resources.ResourceState):
         return res
 
     def _check(self, res):  # TODO -> None but supertype ResourceState -> True
-        avg = self.get_load_avg()
-        if avg == None:
+        # Fetch the load averages and the state of the systemd units in a
+        # single SSH session. The output of systemctl follows a marker line
+        # and is followed by its exit status, so that a missing marker means
+        # the machine (or /proc/loadavg) could not be reached, while a
+        # failing systemctl is still reported as an error.
+        try:
+            out = self.run_command(
+                "cat /proc/loadavg && echo --- &&"
+                " { systemctl --all --full --no-legend; echo $?; }",
+                capture_stdout=True,
+                check=False,
+                timeout=15,
+            )
+        except nixops.ssh_util.SSHConnectionFailed:
+            out = None
+
+        if out is not None and "\n---\n" in out:
+            loadavg, _, units = out.partition("\n---\n")
+            units, _, status = units.rstrip("\n").rpartition("\n")
+        else:
+            status = ""
+
+        # Without an exit status the session ended before systemctl did.
+        if not status.isdigit():
             if self.state == self.UP:
                 self.state = self.UNREACHABLE
             res.is_reachable = False
@@ -155,46 +220,51 @@ class MachineState(nixops.resources.ResourceState):
             self.ssh_pinged = True
             self._ssh_pinged_this_time = True
             res.is_reachable = True
-            res.load = avg
+            res.load = _parse_load_avg(loadavg)
+
+            if status != "0":
+                raise nixops.ssh_util.SSHCommandFailed(
+                    "command ‘systemctl --all --full --no-legend’ failed on "
+                    "machine ‘{0}’".format(self.name),
+                    int(status),
+                )
 
             # Get the systemd units that are in a failed state or in progress.
-            out = self.run_command(
-                "systemctl --all --full --no-legend", capture_stdout=True
-            ).split("\n")
+            # Most lines match none of the patterns below, so test for the
+            # relevant substring before running a regex.
             res.failed_units = []
             res.in_progress_units = []
-            for l in out:
-                match = re.match("^([^ ]+) .* failed .*$", l)
-                if match:
-                    res.failed_units.append(match.group(1))
-
-                # services that are in progress
-                match = re.match("^([^ ]+) .* activating .*$", l)
-                if match:
-                    res.in_progress_units.append(match.group(1))
+            for l in units.splitlines():
+                if " failed " in l or " activating " in l:
+                    match = _UNIT_RE.match(l)
+                    if match:
+                        if match.group("state") == "failed":
+                            res.failed_units.append(match.group("unit"))
+                        else:
+                            res.in_progress_units.append(match.group("unit"))
+                        continue
 
                 # Currently in systemd, failed mounts enter the
                 # "inactive" rather than "failed" state.  So check for
                 # that.  Hack: ignore special filesystems like
                 # /sys/kernel/config and /tmp. Systemd tries to mount these
                 # even when they don't exist.
-                match = re.match("^([^\.]+\.mount) .* inactive .*$", l)
-                if (
-                    match
-                    and not match.group(1).startswith("sys-")
-                    and not match.group(1).startswith("dev-")
-                    and not match.group(1) == "tmp.mount"
-                ):
-                    res.failed_units.append(match.group(1))
-
-                if match and match.group(1) == "tmp.mount":
+                if ".mount " not in l or " inactive " not in l:
+                    continue
+                match = _MOUNT_RE.match(l)
+                if not match:
+                    continue
+                name = match.group(1)
+                if name == "tmp.mount":
                     try:
                         self.run_command(
-                            "cat /etc/fstab | cut -d' ' -f 2 | grep '^/tmp$' &> /dev/null"
+                            "grep -Eqs '^[^[:space:]]+[[:space:]]+/tmp[[:space:]]' /etc/fstab"
                         )
                     except:
                         continue
-                    res.failed_units.append(match.group(1))
+                    res.failed_units.append(name)
+                elif not name.startswith(("sys-", "dev-")):
+                    res.failed_units.append(name)
 
     def restore(self, defn, backup_id: Optional[str], devices: List[str] = []):
         """Restore persistent disks to a given backup, if possible."""
@@ -237,16 +307,19 @@ class MachineState(nixops.resources.ResourceState):
     def reboot_sync(self, hard: bool = False) -> None:
         """Reboot this machine and wait until it's up again."""
         self.reboot(hard=hard)
+        self.wait_for_reboot()
+
+    def wait_for_reboot(self) -> None:
+        """Wait until a machine that was told to reboot is up again."""
         self.log_start("waiting for the machine to finish rebooting...")
+        ssh_name = self.get_ssh_name()
+        ssh_port = self.ssh_port
         nixops.util.wait_for_tcp_port(
-            self.get_ssh_name(),
-            self.ssh_port,
-            open=False,
-            callback=lambda: self.log_continue("."),
+            ssh_name, ssh_port, open=False, callback=lambda: self.log_continue("."),
         )
         self.log_continue("[down]")
         nixops.util.wait_for_tcp_port(
-            self.get_ssh_name(), self.ssh_port, callback=lambda: self.log_continue(".")
+            ssh_name, ssh_port, callback=lambda: self.log_continue(".")
         )
         self.log_end("[up]")
         self.state = self.UP
@@ -269,71 +342,142 @@ class MachineState(nixops.resources.ResourceState):
             return
         if self.store_keys_on_machine:
             return
-        for k, opts in self.get_keys().items():
-            self.log("uploading key ‘{0}’...".format(k))
-            tmp = self.depl.tempdir + "/key-" + self.name
-            if "destDir" not in opts:
-                raise Exception("Key '{}' has no 'destDir' specified.".format(k))
-
-            destDir = opts["destDir"].rstrip("/")
-            self.run_command(
-                (
-                    "test -d '{0}' || ("
-                    " mkdir -m 0750 -p '{0}' &&"
-                    " chown root:keys  '{0}';)"
-                ).format(destDir)
-            )
 
-            if "text" in opts:
-                with open(tmp, "w+") as f:
-                    f.write(opts['text'])
-            elif 'keyCmd' in opts:
-                with open(tmp, "w+") as f:
-                    subprocess.Popen(opts['keyCmd'], stdout=f, shell=True)
-            elif 'keyFile' in opts:
-                self._logged_exec(["cp", opts['keyFile'], tmp])
-            else:
-                raise Exception(
-                    "Neither 'text' or 'keyFile' options were set for key '{0}'.".format(
-                        k
+        # The keys are staged locally first, so that creating the
+        # destination directories and installing the uploaded files can
+        # each be done in a single remote command rather than several
+        # SSH round trips per key.
+        staged = []
+        try:
+            for k, opts in self.get_keys().items():
+                if "destDir" not in opts:
+                    raise Exception("Key '{}' has no 'destDir' specified.".format(k))
+
+                # Each key gets its own file, so that they can be uploaded
+                # concurrently.
+                with tempfile.NamedTemporaryFile(
+                    dir=self.depl.tempdir, prefix="key-" + self.name + "-", delete=False
+                ) as f:
+                    tmp = f.name
+                staged.append((k, opts, tmp))
+
+                if "text" in opts:
+                    with open(tmp, "w") as f:
+                        f.write(opts["text"])
+                elif "keyCmd" in opts:
+                    # Let the command write straight to the file descriptor.
+                    fd = os.open(tmp, os.O_WRONLY | os.O_TRUNC)
+                    try:
+                        subprocess.run(
+                            opts["keyCmd"],
+                            stdout=fd,
+                            stderr=subprocess.PIPE,
+                            shell=True,
+                            check=True,
+                            text=True,
+                        )
+                    except subprocess.CalledProcessError as e:
+                        raise Exception(
+                            "keyCmd for key ‘{0}’ failed with exit code {1}: {2}".format(
+                                k, e.returncode, e.stderr.strip()
+                            )
+                        )
+                    finally:
+                        os.close(fd)
+                elif "keyFile" in opts:
+                    self._logged_exec(["cp", opts["keyFile"], tmp])
+                else:
+                    raise Exception(
+                        "Neither 'text' or 'keyFile' options were set for key '{0}'.".format(
+                            k
+                        )
                     )
-                )
 
-            outfile = destDir + "/" + k
+            if staged:
+                self._upload_keys(staged)
+        finally:
+            for _, _, tmp in staged:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+        self.run_command(
+            "mkdir -m 0750 -p /run/keys && "
+            "chown root:keys  /run/keys && "
+            "touch /run/keys/done"
+        )
+
+    def _upload_keys(self, staged: List[Tuple[str, Dict[str, str], str]]) -> None:
+        """
+        Upload the locally staged key files in 'staged', a list of (name,
+        options, local file) tuples, to their destination directories.
+        """
+        dest_dirs = []
+        tmp_outfiles = []
+        install = []
+        for k, opts, _ in staged:
+            destDir = opts["destDir"].rstrip("/")
+            if destDir not in dest_dirs:
+                dest_dirs.append(destDir)
+
             # We scp to a temporary file and then mv because scp is not atomic.
             # See https://github.com/NixOS/nixops/issues/762
+            outfile = destDir + "/" + k
             tmp_outfile = destDir + "/." + k + ".tmp"
-            outfile_esc = "'" + outfile.replace("'", r"'\''") + "'"
-            tmp_outfile_esc = "'" + tmp_outfile.replace("'", r"'\''") + "'"
-            self.run_command("rm -f " + outfile_esc + " " + tmp_outfile_esc)
-            self.upload_file(tmp, tmp_outfile)
+            tmp_outfiles.append(tmp_outfile)
             # For permissions we use the temporary file as well, so that
             # the final outfile will appear atomically with the right permissions.
-            self.run_command(
+            install.append(
                 " ".join(
                     [
+                        "{{",
                         # chown only if user and group exist,
                         # else leave root:root owned
                         "(",
-                        " getent passwd '{1}' >/dev/null &&",
-                        " getent group '{2}' >/dev/null &&",
-                        " chown '{1}:{2}' {0}",
+                        "getent passwd {1} >/dev/null &&",
+                        "getent group {2} >/dev/null &&",
+                        "chown {1}:{2} {0}",
                         ");",
                         # chmod either way
-                        "chmod '{3}' {0}",
+                        "chmod {3} {0} &&",
+                        "mv {0} {4};",
+                        "}} || {{ echo {5} >&2; exit 1; }}",
                     ]
                 ).format(
-                    tmp_outfile_esc, opts["user"], opts["group"], opts["permissions"]
+                    shlex.quote(tmp_outfile),
+                    shlex.quote(opts["user"]),
+                    shlex.quote(opts["group"]),
+                    shlex.quote(opts["permissions"]),
+                    shlex.quote(outfile),
+                    shlex.quote("unable to install key ‘{0}’".format(k)),
                 )
             )
-            self.run_command("mv " + tmp_outfile_esc + " " + outfile_esc)
-            os.remove(tmp)
-        self.run_command(
-            "mkdir -m 0750 -p /run/keys && "
-            "chown root:keys  /run/keys && "
-            "touch /run/keys/done"
+
+        prepare = [
+            (
+                "{{ test -d {0} ||"
+                " ( mkdir -m 0750 -p {0} && chown root:keys {0}; ); }}"
+            ).format(shlex.quote(d))
+            for d in dest_dirs
+        ]
+        prepare.append("rm -f " + " ".join(shlex.quote(f) for f in tmp_outfiles))
+        self.run_command(" && ".join(prepare))
+
+        def worker(upload: _KeyUpload) -> None:
+            self.log("uploading key ‘{0}’...".format(upload.name))
+            self.upload_file(upload.source, upload.target)
+
+        # The uploads share the SSH master connection.
+        nixops.parallel.run_tasks(
+            nr_workers=min(len(staged), 8),
+            tasks=[
+                _KeyUpload(k, tmp, tmp_outfile)
+                for (k, _, tmp), tmp_outfile in zip(staged, tmp_outfiles)
+            ],
+            worker_fun=worker,
         )
 
+        self.run_command("; ".join(install))
+
     def get_keys(self):
         return self.keys
 
@@ -341,10 +485,13 @@ class MachineState(nixops.resources.ResourceState):
         assert False
 
     def get_ssh_flags(self, scp=False):
-        if scp:
-            return ["-P", str(self.ssh_port)]
-        else:
-            return ["-p", str(self.ssh_port)]
+        # This is called for every SSH and scp invocation, so avoid
+        # reading the port from the state file each time.
+        if self._ssh_flags is None:
+            port = str(self.ssh_port)
+            self._ssh_flags = (("-p", port), ("-P", port))
+        # Return a fresh list, since callers extend the result.
+        return list(self._ssh_flags[1 if scp else 0])
 
     def get_ssh_password(self):
         return None
@@ -429,12 +576,10 @@ class MachineState(nixops.resources.ResourceState):
         ssh = self.get_ssh_for_copy_closure()
 
         # Any remaining paths are copied from the local machine.
-        env = dict(os.environ)
-        env["NIX_SSHOPTS"] = " ".join(ssh._get_flags() + ssh.get_master().opts)
         self._logged_exec(
             ["nix-copy-closure", "--to", ssh._get_target(), path]
             + ([] if self.has_fast_connection else ["--use-substitutes"]),
-            env=env,
+            env={**os.environ, "NIX_SSHOPTS": ssh.get_nix_sshopts()},
         )
 
     def get_scp_name(self):
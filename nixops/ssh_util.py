@@ -257,6 +257,13 @@ class SSH(object):
 
         return weakref.proxy(self._ssh_master)
 
+    def get_nix_sshopts(self) -> str:
+        """
+        Return the SSH options that Nix tools like nix-copy-closure should use
+        (via NIX_SSHOPTS) to connect through the SSH master connection.
+        """
+        return " ".join(self._get_flags() + self.get_master().opts)
+
     @classmethod
     def split_openssh_args(self, args: Iterable[str]) -> Tuple[List[str], Command]:
         """
@@ -1,5 +1,7 @@
 from nixops.logger import Logger
 from io import StringIO
+import json
+import math
 import unittest
 
 from nixops import util
@@ -28,3 +30,38 @@ class TestUtilTest(unittest.TestCase):
         )
 
         self.assertEqual(ret.strip(), msg)
+
+
+class AttrStore(object):
+    data = util.attr_property("data", {}, "json")
+
+    def __init__(self):
+        self.attrs = {}
+
+    def _get_attr(self, name, default):
+        return self.attrs.get(name, util.undefined)
+
+    def _set_attr(self, name, value):
+        self.attrs[name] = value
+
+    def _del_attr(self, name):
+        self.attrs.pop(name, None)
+
+
+class TestJsonAttrPropertyTest(unittest.TestCase):
+    def test_round_trip(self):
+        store = AttrStore()
+
+        store.data = {1: "one", "ünïcödé": ["€", None, True, 1.5, 2 ** 70 + 1]}
+        self.assertEqual(
+            store.data, {"1": "one", "ünïcödé": ["€", None, True, 1.5, 2 ** 70 + 1]}
+        )
+        self.assertIsInstance(store.data["ünïcödé"][4], int)
+
+        store.attrs["data"] = json.dumps({"x": float("nan"), "y": float("inf")})
+        self.assertTrue(math.isnan(store.data["x"]))
+        self.assertEqual(store.data["y"], float("inf"))
+
+        store.data = {}
+        self.assertNotIn("data", store.attrs)
+        self.assertEqual(store.data, {})